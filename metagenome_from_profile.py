@@ -57,6 +57,15 @@ def parse_options():
     helptext = "Only perform community design, do not simulate"
     parser.add_argument("-d", "--community-only", action='store_true', default=False, help=helptext)
     
+    helptext = "Number of threads used for downloading genomes, default 1"
+    parser.add_argument("--threads", type=int, default=1, help=helptext)
+
+    helptext = "Number of processes used for looking up the lineages of the reference genomes (at most the number of cpus, every process opens its own NCBI database), default 1"
+    parser.add_argument("--processes", type=int, default=1, help=helptext)
+
+    helptext = "Map OTUs to genomes with numba (needs numba installed). Faster for large profiles, but different strains are drawn than without this option, even for the same seed"
+    parser.add_argument("--numba", action='store_true', default=False, help=helptext)
+
     helptext="Seed for the random generator"
     parser.add_argument("--seed",type=int,default=None,help=helptext)
 
@@ -1,21 +1,167 @@
 import sys
 import os
+import re
+import json
 import urllib2
-import gzip
+import zlib
 import biom
 import shutil
+import multiprocessing
+from collections import OrderedDict, deque
+from multiprocessing.pool import ThreadPool
+import numpy as np
 from numpy import random as np_rand
+from scipy.sparse import coo_matrix, csc_matrix
 from ete2 import NCBITaxa
 from scripts.loggingwrapper import LoggingWrapper as logger
 try:
     from configparser import ConfigParser
 except ImportError:
     from ConfigParser import ConfigParser
+try:
+    from numba import njit
+except ImportError:
+    njit = None # OTUs are then mapped to genomes in pure python
+try:
+    import requests
+    from requests.adapters import HTTPAdapter
+except ImportError:
+    requests = None # genomes are then downloaded with urllib2, without connection reuse
+try:
+    import h5py
+except ImportError:
+    h5py = None # HDF5 BIOM files are then read by biom itself
 
 ncbi = NCBITaxa()
 RANKS = ['species', 'genus', 'family', 'order', 'class', 'phylum', 'superkingdom']
 MAX_RANK = 'family'
 _log = None
+_lineage_cache = {}
+_rank_cache = {}
+_session = None
+HDF5_SIGNATURE = b'\x89HDF\r\n\x1a\n'
+JSON_WHITESPACE = re.compile(r'\s*')
+JSON_DATA_END = re.compile(r'\]\s*\]')
+JSON_NUMBERS = re.compile(r'[\s\d.,eE+\-\[\]]*\Z')
+N_STRETCH = re.compile('N+')
+WHITESPACE = re.compile(r'\s')
+
+"""
+Decodes byte strings read from a HDF5 file (python 3 only, in python 2 they are already str)
+"""
+def _decode(values):
+    return [value if isinstance(value, str) else value.decode('utf-8') for value in values]
+
+"""
+Reads the observation ids, sample ids, taxonomies and the first no_samples columns of the abundance matrix
+from a BIOM file in HDF5 format, without reading the observation-major copy of the matrix or any other metadata
+"""
+def _load_biom_hdf5(biom_profile, no_samples):
+    with h5py.File(biom_profile, 'r') as biom_file:
+        ids = _decode(biom_file['observation/ids'][:])
+        samples = _decode(biom_file['sample/ids'][:])
+        taxonomies = []
+        for taxonomy in biom_file['observation/metadata/taxonomy'][:]:
+            if isinstance(taxonomy, np.ndarray):
+                taxonomies.append([member for member in _decode(taxonomy) if member != ""]) # remove padding, as biom does
+            else:
+                taxonomies.append(_decode([taxonomy])[0]) # taxonomy stored as single string
+        n = len(samples) if no_samples is None else min(no_samples, len(samples))
+        indptr = biom_file['sample/matrix/indptr'][:n + 1] # sample-major (csc) copy of the matrix
+        data = biom_file['sample/matrix/data'][indptr[0]:indptr[-1]]
+        indices = biom_file['sample/matrix/indices'][indptr[0]:indptr[-1]]
+    matrix = csc_matrix((data, indices, indptr - indptr[0]), shape=(len(ids), n))
+    return ids, samples, taxonomies, matrix
+
+"""
+Returns the end position of the data array (a list of lists of numbers) starting at position start of content
+"""
+def _json_data_end(content, start):
+    if content[start:start + 1] != "[":
+        raise ValueError("BIOM data field at position %s is not an array" % start)
+    end = JSON_WHITESPACE.match(content, start + 1).end()
+    if content[end:end + 1] == "]": # empty data field
+        return end + 1
+    match = JSON_DATA_END.search(content, start) # non-empty data field ends with the closing brackets of the last row
+    if match is None or JSON_NUMBERS.match(content, start, match.end()) is None:
+        raise ValueError("BIOM data field at position %s is not a list of lists of numbers" % start)
+    return match.end()
+
+"""
+Walks the top-level object of a BIOM JSON document and decodes all fields but the data field,
+whose (start, end) position in content is returned instead
+"""
+def _split_biom_json(content):
+    decoder = json.JSONDecoder()
+    table = {}
+    data_span = None
+    pos = JSON_WHITESPACE.match(content).end()
+    if content[pos:pos + 1] != "{":
+        raise ValueError("BIOM JSON does not contain an object")
+    pos = JSON_WHITESPACE.match(content, pos + 1).end()
+    while content[pos:pos + 1] != "}":
+        key, pos = decoder.raw_decode(content, pos)
+        pos = JSON_WHITESPACE.match(content, pos).end()
+        if content[pos:pos + 1] != ":":
+            raise ValueError("Expected ':' at position %s of BIOM JSON" % pos)
+        pos = JSON_WHITESPACE.match(content, pos + 1).end()
+        if key == "data":
+            end = _json_data_end(content, pos)
+            data_span = (pos, end)
+            pos = end
+        else:
+            table[key], pos = decoder.raw_decode(content, pos)
+        pos = JSON_WHITESPACE.match(content, pos).end()
+        if content[pos:pos + 1] == ",":
+            pos = JSON_WHITESPACE.match(content, pos + 1).end()
+        elif content[pos:pos + 1] != "}":
+            raise ValueError("Expected ',' or '}' at position %s of BIOM JSON" % pos)
+    if data_span is None:
+        raise ValueError("BIOM JSON has no data field")
+    return table, data_span
+
+"""
+Reads the observation ids, sample ids, taxonomies and the first no_samples columns of the abundance matrix
+from a BIOM file in JSON format. The (large) top-level data field is cut out and parsed by numpy, only the other fields go through the json decoder
+"""
+def _load_biom_json(biom_profile, no_samples):
+    with open(biom_profile, 'r') as biom_file:
+        content = biom_file.read()
+    table, (start, end) = _split_biom_json(content)
+    numbers = content[start:end].replace('[', ' ').replace(']', ' ')
+    values = np.fromstring(numbers, sep=',') if numbers.strip() != "" else np.zeros(0)
+    ids = [row["id"] for row in table["rows"]]
+    samples = [column["id"] for column in table["columns"]]
+    taxonomies = [row["metadata"]["taxonomy"] for row in table["rows"]]
+    n = len(samples) if no_samples is None else min(no_samples, len(samples))
+    if table["matrix_type"] == "sparse":
+        entries = values.reshape(-1, 3) # row, column, value
+        entries = entries[entries[:, 1] < n]
+        matrix = coo_matrix((entries[:, 2], (entries[:, 0].astype(int), entries[:, 1].astype(int))), shape=(len(ids), n)).tocsc()
+    else:
+        matrix = csc_matrix(values.reshape(len(ids), len(samples))[:, :n])
+    return ids, samples, taxonomies, matrix
+
+"""
+Reads a BIOM file without building a full biom table, returns observation ids, sample ids, taxonomies and the abundance matrix
+restricted to the first no_samples samples, or None if the file can not be read this way (e.g. tsv BIOM or h5py not available)
+"""
+def load_biom_profile(biom_profile, no_samples = None):
+    with open(biom_profile, 'rb') as biom_file:
+        head = biom_file.read(4096)
+    if head.startswith(HDF5_SIGNATURE):
+        if h5py is None:
+            return None
+        load = _load_biom_hdf5
+    elif head.lstrip()[:1] == b'{':
+        load = _load_biom_json
+    else:
+        return None # classic (tsv) table
+    try:
+        return load(biom_profile, no_samples)
+    except (ValueError, KeyError, IndexError, TypeError, IOError, OSError) as e: # unexpected layout of the file
+        _log.warning("Could not read BIOM file %s directly (%s), using biom" % (biom_profile, repr(e)))
+        return None
 
 """
 Reads a BIOM file and creates map of OTU: lineage, abundance
@@ -23,9 +169,15 @@ BIOM file format needs to have a taxonomy field in metadata which contains the t
 RANK__SCINAME; LOWERRANK_LOWERSCINAME
 """
 def read_taxonomic_profile(biom_profile, config, no_samples = None):
-    table = biom.load_table(biom_profile)
-    ids = table.ids(axis="observation")
-    samples = table.ids()
+    biom_profile_data = load_biom_profile(biom_profile, no_samples)
+    if biom_profile_data is None:
+        table = biom.load_table(biom_profile)
+        ids = table.ids(axis="observation")
+        samples = table.ids()
+        taxonomies = [md["taxonomy"] for md in table.metadata(axis="observation")] # in the same order as ids, no lookup per id
+        matrix = table.matrix_data
+    else:
+        ids, samples, taxonomies, matrix = biom_profile_data
 
     if no_samples is None:
         no_samples = len(samples)
@@ -38,16 +190,13 @@ def read_taxonomic_profile(biom_profile, config, no_samples = None):
 
     config.set("Main", "number_of_samples", str(no_samples))
     profile = {}
-    for otu in ids:
-        lineage = table.metadata(otu,axis="observation")["taxonomy"]
+    matrix = matrix.tocsc()[:, :no_samples].toarray() # rows are in the same order as ids
+    for idx, (otu, lineage) in enumerate(zip(ids, taxonomies)):
         try:
             lineage = lineage.split(";") # if no spaces
         except AttributeError:
             pass
-        abundances = []
-        for sample in samples[:no_samples]:
-            abundances.append(table.get_value_by_ids(otu,sample))
-        profile[otu] = (lineage, abundances)
+        profile[otu] = (lineage, matrix[idx].tolist())
     
     return profile
 
@@ -81,49 +230,120 @@ def read_genomes_list(genomes_path, additional_file = None):
             total_genomes += 1
     return genomes_map, total_genomes
 
+"""
+Returns the NCBI lineage of the given tax id, lineages are cached since they are requested for many genomes
+"""
+def get_lineage(taxid):
+    if taxid not in _lineage_cache:
+        _lineage_cache[taxid] = ncbi.get_lineage(taxid)
+    return _lineage_cache[taxid]
+
+"""
+Returns map tax id: rank for the given tax ids, only tax ids which have not been seen before are queried from the NCBI database
+"""
+def get_ranks(taxids):
+    missing = [taxid for taxid in set(taxids) if taxid not in _rank_cache]
+    if len(missing) > 0:
+        id2rank = ncbi.get_rank(missing)
+        for taxid in missing:
+            _rank_cache[taxid] = id2rank.get(taxid) # None if tax id is unknown, so it is not queried again
+    return dict((taxid, _rank_cache[taxid]) for taxid in taxids)
+
+"""
+Opens a separate connection to the NCBI taxonomy database in every worker process, the sqlite connection can not be shared with forked processes
+"""
+def _init_ncbi():
+    global ncbi
+    ncbi = NCBITaxa()
+
+"""
+Returns the lineage of a single genome and the ranks of its members, run in the worker processes
+"""
+def _lineage_for(genome):
+    lineage = ncbi.get_lineage(genome)
+    return genome, lineage, ncbi.get_rank(lineage)
+
 """
 Given all available genomes, creates a map sorted by ranks of available genomes on that particular rank, ordered by their ncbi ids
+The genomes of a tax id are stored as keys of an OrderedDict, so they can be removed in constant time while keeping their order
+Additionally returns the inverted index genome: list of (rank, tax id) the genome appears on
+With more than one process, the lineages are looked up by a pool of processes (at most one per cpu), each with its own NCBI database connection
 """
-def get_genomes_per_rank(genomes_map, ranks, max_rank):
+def get_genomes_per_rank(genomes_map, ranks, max_rank, processes = 1):
     per_rank_map = {}
+    genome_locations = {}
     for rank in ranks:
         per_rank_map[rank] = {}
+    missing = [genome for genome in genomes_map if genome not in _lineage_cache]
+    processes = min(processes, multiprocessing.cpu_count())
+    if processes > 1 and len(missing) > 0: # look up lineages in parallel and fill the caches
+        pool = multiprocessing.Pool(processes, initializer=_init_ncbi)
+        try:
+            for genome, lineage, id2rank in pool.imap_unordered(_lineage_for, missing, chunksize=256):
+                _lineage_cache[genome] = lineage
+                _rank_cache.update(id2rank)
+        finally:
+            pool.close()
+            pool.join()
+    lineages = {}
+    all_ids = set()
     for genome in genomes_map:
-        lineage = ncbi.get_lineage(genome) # this might contain some others ranks than ranks
-        ranks = ncbi.get_rank(lineage)
-        for tax_id in lineage: # go over the lineage
-            if ranks[tax_id] in per_rank_map: # if we are a legal rank
-                rank_map = per_rank_map[ranks[tax_id]]
-                if tax_id in rank_map: # tax id already has a genome
-                    for strain in genomes_map[genome][1]:
-                        rank_map[tax_id].append((strain,genome)) # add http address
-                else:
-                    rank_map[tax_id] = []
-                    for strain in genomes_map[genome][1]:
-                        rank_map[tax_id].append((strain,genome)) # add http address
-    return per_rank_map
+        lineages[genome] = get_lineage(genome) # this might contain some others ranks than ranks
+        all_ids.update(lineages[genome])
+    id2rank = get_ranks(all_ids) # single query for all lineages
+    for genome in genomes_map:
+        for tax_id in lineages[genome]: # go over the lineage
+            rank = id2rank.get(tax_id)
+            if rank in per_rank_map: # if we are a legal rank
+                rank_map = per_rank_map[rank]
+                if tax_id not in rank_map: # tax id has no genome yet
+                    rank_map[tax_id] = OrderedDict()
+                for strain in genomes_map[genome][1]:
+                    rank_map[tax_id][(strain,genome)] = None # add http address
+                    genome_locations.setdefault((strain,genome), []).append((rank, tax_id))
+    return per_rank_map, genome_locations
+
+"""
+Collects the scientific names of all OTUs in the profile and translates them to NCBI tax ids and ranks,
+so that the NCBI database is only queried once instead of once per lineage member
+"""
+def get_taxonomy_maps(profile):
+    names = set()
+    for otu in profile:
+        lineage, abundances = profile[otu]
+        for member in lineage:
+            name = member.split("__")[-1] # name is on the right hand side
+            if len(name) == 0:
+                continue
+            names.add(name)
+            split_name = name.split()
+            if len(split_name) > 0:
+                names.add(split_name[0]) # retry if space in name destroys ID
+    name2tax = {}
+    if len(names) > 0:
+        for name, taxids in ncbi.get_name_translator(list(names)).items():
+            name2tax[name] = taxids[0] # should contain only one element
+    id2rank = get_ranks(name2tax.values())
+    return name2tax, id2rank
 
 """
-Given a BIOM lineage, create a NCBI tax id lineage
+Given a BIOM lineage, create a NCBI tax id lineage and the map tax id: rank of its members
 """
-def transform_lineage(lineage, ranks, max_rank):
+def transform_lineage(lineage, ranks, max_rank, name2tax, id2rank):
     new_lineage = []
+    rank_of = {}
     for member in lineage:
         name = member.split("__")[-1] # name is on the right hand side
         if len(name) == 0:
             continue
-        mapping = ncbi.get_name_translator([name])
-        if name in mapping:
-            taxid = mapping[name][0]
-            if ncbi.get_rank([taxid])[taxid] in ranks:
-                new_lineage.append(taxid) # should contain only one element
-        else:
-            name = name.split()[0]
-            if name in mapping:
-                taxid = mapping[name][0]
-                if ncbi.get_rank([taxid])[taxid] in ranks:
-                    new_lineage.append(taxid) # retry if space in name destroys ID
-    return new_lineage[::-1] # invert list, so lowest rank appears first (last in BIOM)
+        if name not in name2tax and len(name.split()) > 0:
+            name = name.split()[0] # retry if space in name destroys ID
+        if name in name2tax:
+            taxid = name2tax[name]
+            if id2rank.get(taxid) in ranks and taxid not in rank_of: # the first word retry may resolve to a tax id which is already in the lineage
+                new_lineage.append(taxid)
+                rank_of[taxid] = id2rank[taxid]
+    return new_lineage[::-1], rank_of # invert list, so lowest rank appears first (last in BIOM)
 
 """
 Sorts the otus in the profile by abundance
@@ -146,107 +366,382 @@ def all_genomes(per_rank_map):
                     added_genomes.add(path)
     _log.info(len(added_genomes))
 
+"""
+Removes a used genome from all tax ids it appears on, tax ids without genomes left are removed as well,
+so a membership test on the rank map tells whether genomes are still available
+"""
+def remove_genome(per_rank_map, genome_locations, genome):
+    for rank, taxid in genome_locations.pop(genome, ()):
+        genomes = per_rank_map[rank][taxid]
+        del genomes[genome]
+        if len(genomes) == 0:
+            del per_rank_map[rank][taxid]
+
+"""
+Returns the OTUs sorted by abundance, their NCBI lineages (lowest rank first) together with the map tax id: rank of every lineage,
+and the position of every rank in ranks
+"""
+def _prepare_otus(profile, ranks, max_rank, name2tax, id2rank):
+    rank_index = dict((rank, i) for i, rank in enumerate(ranks)) # position of every rank, lowest first
+    sorted_otus = sort_by_abundance(profile)
+    lineages = [transform_lineage(profile[otu][0], ranks, max_rank, name2tax, id2rank) for otu in sorted_otus]
+    return sorted_otus, lineages, rank_index
+
+"""
+Marks an OTU as unmatched, either because no NCBI ID was found for its lineage or because rank is above the max rank
+"""
+def _add_unmatched_otu(otu, lin, lineage, rank, warnings, unmatched_otus):
+    if len(lineage) == 0:
+        warnings.append("No matching NCBI ID for otu %s, scientific name %s" % (otu, lin[-1].split("__")[-1]))
+    else:
+        warnings.append("Rank %s of OTU %s too high, no matching genomes found" % (rank, otu))
+        warnings.append("Full lineage was %s, mapped from BIOM lineage %s" % (lineage, lin))
+    unmatched_otus.append(otu)
+
+"""
+Splits the abundances of an OTU onto the drawn genomes and adds them as OTU.0, OTU.1, ... to otu_genome_map,
+with no_replace the genomes are removed from the rank map so they are not drawn again
+"""
+def _add_strains(otu_genome_map, otu, tax_id, used_genomes, relative_abundances, abundances, no_replace, per_rank_map, genome_locations):
+    strain_abundances = np.multiply.outer(relative_abundances, np.asarray(abundances, dtype=np.float64)) # abundance per strain and sample
+    for i, (path, genome_id) in enumerate(used_genomes):
+        otu_id = otu + "." + str(i)
+        otu_genome_map[otu_id] = (tax_id, genome_id, path, strain_abundances[i].tolist()) # taxid, genomeid, http path, abundances per sample
+        if (no_replace): # sampling without replacement:
+            remove_genome(per_rank_map, genome_locations, (path, genome_id))
+
+"""
+Adds the warning that no genomes are available for the tax id of an OTU on the given rank
+"""
+def _add_missing_genomes(otu, rank, tax_id, warnings):
+    warnings.append("For OTU %s no genomes have been found on rank %s with ID %s" % (otu, rank, tax_id))
+
+"""
+Logs the warnings collected while mapping OTUs to genomes, every single warning only with debug
+"""
+def _log_mapping_warnings(warnings, debug):
+    if len(warnings) > 0:
+        _log.warning("Some OTUs could not be mapped")
+        if debug:
+            for warning in warnings:
+                _log.warning(warning)
+
 """
 Given the OTU to lineage/abundances map and the genomes to lineage map, create map otu: taxid, genome, abundances
 """
-def map_otus_to_genomes(profile, per_rank_map, ranks, max_rank, mu, sigma, max_strains, debug, no_replace, max_genomes):
+def map_otus_to_genomes(profile, per_rank_map, ranks, max_rank, mu, sigma, max_strains, debug, no_replace, max_genomes, name2tax, id2rank, genome_locations, use_numba = False):
+    if use_numba and njit is None:
+        _log.warning("numba is not installed, mapping OTUs to genomes in python")
+    elif use_numba:
+        return map_otus_to_genomes_numba(profile, per_rank_map, ranks, max_rank, mu, sigma, max_strains, debug, no_replace, max_genomes, name2tax, id2rank, genome_locations)
     unmatched_otus = []
     otu_genome_map = {}
     warnings = []
-    sorted_otus = sort_by_abundance(profile)
+    sorted_otus, lineages, rank_index = _prepare_otus(profile, ranks, max_rank, name2tax, id2rank)
+    max_rank_index = rank_index[max_rank]
     genome_set_size = 0
-    for otu in sorted_otus:
+    for otu, (lineage, lineage_ranks) in zip(sorted_otus, lineages):
         if genome_set_size >= max_genomes and no_replace: #cancel if no genomes are available anymore
             break
         lin, abundances = profile[otu]
-        lineage = transform_lineage(lin, ranks, max_rank)
         if len(lineage) == 0:
-            warnings.append("No matching NCBI ID for otu %s, scientific name %s" % (otu, lin[-1].split("__")[-1]))
-            unmatched_otus.append(otu)
-        lineage_ranks = ncbi.get_rank(lineage)
+            _add_unmatched_otu(otu, lin, lineage, None, warnings, unmatched_otus)
         for tax_id in lineage: # lineage sorted ascending
             rank = lineage_ranks[tax_id]
-            if ranks.index(rank) > ranks.index(max_rank):
-                warnings.append("Rank %s of OTU %s too high, no matching genomes found" % (rank, otu))
-                warnings.append("Full lineage was %s, mapped from BIOM lineage %s" % (lineage, lin))
-                unmatched_otus.append(otu)
+            if rank_index[rank] > max_rank_index:
+                _add_unmatched_otu(otu, lin, lineage, rank, warnings, unmatched_otus)
                 break
             genomes = per_rank_map[rank]
             if tax_id not in genomes:
-                warnings.append("For OTU %s no genomes have been found on rank %s with ID %s" % (otu, rank, tax_id))
+                _add_missing_genomes(otu, rank, tax_id, warnings)
                 continue # warning will appear later if rank is too high
-            available_genomes = genomes[tax_id]
+            available_genomes = list(genomes[tax_id])
             strains_to_draw = max((np_rand.geometric(2./max_strains) % max_strains),1)
             if len(available_genomes) >= strains_to_draw:
                 used_indices = np_rand.choice(len(available_genomes),strains_to_draw,replace=False)
-                used_genomes = set([available_genomes[i] for i in used_indices])
+                used_genomes = [available_genomes[i] for i in used_indices] # same order as the lognormal values
             else:
-                used_genomes = set(available_genomes) # if not enough genomes: use all
+                used_genomes = available_genomes # if not enough genomes: use all
             genome_set_size += len(used_genomes) # how many genomes are used
             log_normal_vals = np_rand.lognormal(mu,sigma, len(used_genomes))
-            sum_log_normal = sum(log_normal_vals)
-            i = 0
-            for path, genome_id in used_genomes:
-                otu_id = otu + "." + str(i)
-                otu_genome_map[otu_id] = (tax_id, genome_id, path, []) # taxid, genomeid, http path, abundances per sample
-                relative_abundance = log_normal_vals[i]/sum_log_normal
-                i += 1
-                for abundance in abundances: # calculate abundance per sample
-                    current_abundance = relative_abundance * abundance
-                    otu_genome_map[otu_id][-1].append(current_abundance)
-                if (no_replace): # sampling without replacement:
-                    for new_rank in per_rank_map:
-                        for taxid in per_rank_map[new_rank]:
-                            if (path, genome_id) in per_rank_map[new_rank][taxid]:
-                                per_rank_map[new_rank][taxid].remove((path,genome_id))
+            _add_strains(otu_genome_map, otu, tax_id, used_genomes, log_normal_vals / log_normal_vals.sum(), abundances, no_replace, per_rank_map, genome_locations)
             break # genome(s) found: we can break
-    if len(warnings) > 0:
-        _log.warning("Some OTUs could not be mapped")
-        if debug:
-            for warning in warnings:
-                _log.warning(warning)
+    _log_mapping_warnings(warnings, debug)
     return otu_genome_map, unmatched_otus, per_rank_map
 
 
+if njit is not None:
+    """
+    Numba kernel of map_otus_to_genomes. Lineages are rows of tax id indices, the genomes of tax id t are genome_ids[offsets[t]:offsets[t+1]]
+    For every OTU status is set to 0 (no lineage), 1 (genomes drawn), 2 (rank too high) or 3 (no genomes on any rank), -1 if it was not processed
+    stop_pos is the lineage position the OTU was mapped on (or found too high), the drawn genomes and their relative abundances are stored per OTU
+    """
+    @njit(cache=True)
+    def _assign_strains(lineages, lineage_lengths, taxid_ranks, has_genomes, offsets, genome_ids, n_genomes, max_rank_index, max_strains, mu, sigma, no_replace, max_genomes, seed, status, stop_pos, out_counts, out_genomes, out_relative):
+        np.random.seed(seed)
+        used = np.zeros(n_genomes, np.bool_)
+        genome_set_size = 0
+        for o in range(lineages.shape[0]):
+            if genome_set_size >= max_genomes and no_replace: # cancel if no genomes are available anymore
+                break
+            if lineage_lengths[o] == 0:
+                status[o] = 0
+                continue
+            status[o] = 3
+            for p in range(lineage_lengths[o]): # lineage sorted ascending
+                t = lineages[o, p]
+                if taxid_ranks[t] > max_rank_index:
+                    status[o] = 2
+                    stop_pos[o] = p
+                    break
+                if not has_genomes[t]:
+                    continue
+                available = np.empty(offsets[t + 1] - offsets[t], np.int64)
+                n_available = 0
+                for j in range(offsets[t], offsets[t + 1]):
+                    if not used[genome_ids[j]]:
+                        available[n_available] = genome_ids[j]
+                        n_available += 1
+                if n_available == 0: # all genomes of this tax id have already been used
+                    continue
+                strains_to_draw = max(np.random.geometric(2./max_strains) % max_strains, 1)
+                if n_available >= strains_to_draw:
+                    used_indices = np.random.choice(n_available, strains_to_draw, replace=False)
+                    n_used = strains_to_draw
+                    for k in range(n_used):
+                        out_genomes[o, k] = available[used_indices[k]]
+                else:
+                    n_used = n_available # if not enough genomes: use all
+                    for k in range(n_used):
+                        out_genomes[o, k] = available[k]
+                genome_set_size += n_used
+                log_normal_vals = np.random.lognormal(mu, sigma, n_used)
+                sum_log_normal = log_normal_vals.sum()
+                for k in range(n_used):
+                    out_relative[o, k] = log_normal_vals[k] / sum_log_normal
+                    if no_replace: # sampling without replacement
+                        used[out_genomes[o, k]] = True
+                out_counts[o] = n_used
+                status[o] = 1
+                stop_pos[o] = p
+                break # genome(s) found: we can break
+
 """
-Take fasta input file and split by any N occurence (and remove Ns)
+Same as map_otus_to_genomes, but the sampling runs in a numba kernel on integer encoded lineages and genome lists (only used if requested)
+The kernel uses the random generator of numba (seeded from numpy), so the drawn strains differ from the pure python version for the same seed
 """
-def split_by_N(fasta_path, out_path):
-    os.system("scripts/split_fasta.pl %s %s" % (fasta_path, out_path))
-    os.remove(fasta_path)
+def map_otus_to_genomes_numba(profile, per_rank_map, ranks, max_rank, mu, sigma, max_strains, debug, no_replace, max_genomes, name2tax, id2rank, genome_locations):
+    unmatched_otus = []
+    otu_genome_map = {}
+    warnings = []
+    sorted_otus, lineages, rank_index = _prepare_otus(profile, ranks, max_rank, name2tax, id2rank)
+    max_rank_index = rank_index[max_rank]
+    taxids = []
+    taxid_index = {}
+    taxid_rank_map = {}
+    for lineage, rank_of in lineages:
+        taxid_rank_map.update(rank_of)
+        for tax_id in lineage:
+            if tax_id not in taxid_index:
+                taxid_index[tax_id] = len(taxids)
+                taxids.append(tax_id)
+    genomes = []
+    genome_index = {}
+    taxid_ranks = np.empty(len(taxids), np.int64)
+    has_genomes = np.zeros(len(taxids), np.bool_)
+    offsets = np.zeros(len(taxids) + 1, np.int64)
+    genome_ids = []
+    for t, tax_id in enumerate(taxids):
+        rank = taxid_rank_map[tax_id]
+        taxid_ranks[t] = rank_index[rank]
+        if tax_id in per_rank_map[rank]:
+            has_genomes[t] = True
+            for genome in per_rank_map[rank][tax_id]:
+                if genome not in genome_index:
+                    genome_index[genome] = len(genomes)
+                    genomes.append(genome)
+                genome_ids.append(genome_index[genome])
+        offsets[t + 1] = len(genome_ids)
+    max_length = max([len(lineage) for lineage, rank_of in lineages] + [1])
+    lineage_array = np.zeros((len(lineages), max_length), np.int64)
+    lineage_lengths = np.zeros(len(lineages), np.int64)
+    for o, (lineage, rank_of) in enumerate(lineages):
+        lineage_lengths[o] = len(lineage)
+        for p, tax_id in enumerate(lineage):
+            lineage_array[o, p] = taxid_index[tax_id]
+    status = np.full(len(lineages), -1, np.int64)
+    stop_pos = np.zeros(len(lineages), np.int64)
+    out_counts = np.zeros(len(lineages), np.int64)
+    out_genomes = np.zeros((len(lineages), max(max_strains, 1)), np.int64)
+    out_relative = np.zeros((len(lineages), max(max_strains, 1)), np.float64)
+    _assign_strains(lineage_array, lineage_lengths, taxid_ranks, has_genomes, offsets, np.asarray(genome_ids, np.int64), len(genomes),
+        max_rank_index, max_strains, float(mu), float(sigma), bool(no_replace), max_genomes, np_rand.randint(2**31 - 1),
+        status, stop_pos, out_counts, out_genomes, out_relative)
+    for o, otu in enumerate(sorted_otus): # convert the kernel output to the output of map_otus_to_genomes
+        if status[o] == -1:
+            break
+        lin, abundances = profile[otu]
+        lineage = lineages[o][0]
+        if status[o] == 0:
+            _add_unmatched_otu(otu, lin, lineage, None, warnings, unmatched_otus)
+            continue
+        last = len(lineage) if status[o] == 3 else stop_pos[o]
+        for tax_id in lineage[:last]: # the kernel only skips tax ids without (unused) genomes
+            _add_missing_genomes(otu, taxid_rank_map[tax_id], tax_id, warnings)
+        if status[o] == 2:
+            _add_unmatched_otu(otu, lin, lineage, taxid_rank_map[lineage[last]], warnings, unmatched_otus)
+        elif status[o] == 1:
+            used_genomes = [genomes[g] for g in out_genomes[o, :out_counts[o]]]
+            _add_strains(otu_genome_map, otu, lineage[last], used_genomes, out_relative[o, :out_counts[o]], abundances, no_replace, per_rank_map, genome_locations)
+    _log_mapping_warnings(warnings, debug)
+    return otu_genome_map, unmatched_otus, per_rank_map
+
 
 """
-Downloads the given genome and returns the out path
+Writes a single fasta record, split at every stretch of Ns. Every contig but the first gets its running number appended to the ID,
+all contigs get their size appended to the header. Records without Ns are written unchanged
+"""
+def write_split_record(name, sequence, out):
+    if sequence == "":
+        return
+    contigs = N_STRETCH.split(sequence)
+    while len(contigs) > 0 and contigs[-1] == "": # trailing Ns do not create an empty contig
+        contigs.pop()
+    if len(contigs) > 1:
+        fasta_names = WHITESPACE.split(name)
+        while len(fasta_names) > 0 and fasta_names[-1] == "":
+            fasta_names.pop()
+        for ctgcount, contig in enumerate(contigs, 1):
+            fasta_name = ""
+            for i, spl in enumerate(fasta_names):
+                fasta_name += spl
+                if ctgcount > 1 and i == 0:
+                    fasta_name += "_%s" % ctgcount
+                fasta_name += " "
+            out.write("%s (size=%s)\n%s\n" % (fasta_name, len(contig), contig))
+    else:
+        out.write("%s\n%s\n" % (name, sequence))
+
+"""
+Reads fasta lines and writes the records to out, with upper case sequences and split by any N occurence (and Ns removed)
+"""
+def write_split_fasta(lines, out):
+    name = ""
+    sequence = []
+    for line in lines:
+        line = line.rstrip("\n")
+        if line.startswith(">"):
+            write_split_record(name, "".join(sequence), out)
+            name = line
+            sequence = []
+        else:
+            sequence.append(line.upper())
+    write_split_record(name, "".join(sequence), out)
+
+"""
+Decompresses the gzipped stream src chunk by chunk and yields its lines, so neither the compressed nor the decompressed file is held in memory
+"""
+def gunzip_lines(src, length = 1 << 20):
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS) # gzip header, GzipFile would require a seekable source in python 2
+    rest = ""
+    while True:
+        chunk = src.read(length)
+        if not chunk:
+            break
+        data = decompressor.decompress(chunk)
+        while decompressor.unused_data: # concatenated gzip members, each needs a fresh decompressor
+            unused = decompressor.unused_data
+            data += decompressor.flush()
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            data += decompressor.decompress(unused)
+        lines = (rest + data).split("\n")
+        rest = lines.pop() # last line might be incomplete
+        for line in lines:
+            yield line
+    if decompressor.decompress("\0") != "" or decompressor.unused_data != "\0": # a byte after the end of the last member is left unused
+        raise IOError("Compressed stream ended before the end of the last gzip member, the download is truncated")
+    for line in (rest + decompressor.flush()).split("\n"):
+        if line != "":
+            yield line
+
+"""
+Creates the HTTP session shared by all download threads, so connections to the server are kept alive and reused
+"""
+def create_session(threads):
+    global _session
+    if requests is None:
+        return
+    _session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=threads, pool_maxsize=threads)
+    _session.mount('http://', adapter)
+    _session.mount('https://', adapter)
+
+"""
+Closes the HTTP session and its pooled connections once all genomes have been downloaded
+"""
+def close_session():
+    global _session
+    if _session is not None:
+        _session.close()
+        _session = None
+
+"""
+Downloads the given genome, splits it by any N occurence while it is decompressed and returns the out path
 """
 def download_genome(genome, out_path):
     genome_path = os.path.join(out_path,"genomes")
     out_name = genome.rstrip().split('/')[-1]
     http_address = os.path.join(genome, out_name + "_genomic.fna.gz")
-    opened = urllib2.urlopen(http_address)
     out = os.path.join(genome_path, out_name + ".fa")
-    tmp_out = os.path.join(genome_path, out_name + "tmp.fa")
-    out_gz = out + ".gz"
-    with open(out_gz,'wb') as outF:
-        outF.write(opened.read())
-    gf = gzip.open(out_gz)
-    new_out = open(tmp_out,'wb')
-    new_out.write(gf.read())
-    gf.close()
-    os.remove(out_gz)
-    new_out.close()
-    split_by_N(tmp_out, out)
+    streamed = _session is not None and (http_address.startswith('http://') or http_address.startswith('https://')) # requests does not support ftp
+    if streamed:
+        opened = _session.get(http_address, stream=True)
+        source = opened.raw
+    else:
+        opened = urllib2.urlopen(http_address)
+        source = opened
+    try:
+        if streamed:
+            opened.raise_for_status() # urllib2 raises on errors itself
+        with open(out,'wb') as new_out:
+            write_split_fasta(gunzip_lines(source), new_out)
+    finally:
+        opened.close()
     return out
 
+"""
+Downloads (or copies, if the path is local) a single genome, retrying up to 10 times, and returns the original and the resulting genome path
+"""
+def fetch_genome(task):
+    genome_id, path, out_path = task
+    create_path = os.path.join(out_path,"genomes")
+    genome_path = None
+    counter = 0
+    while counter < 10:
+        try:
+            if path.startswith('http') or path.startswith('ftp'):
+                genome_path = download_genome(path, out_path)
+            else:
+                out_name = path.rstrip().split('/')[-1]
+                genome_path = os.path.join(create_path, out_name)
+                shutil.copy2(path, genome_path)
+            break
+        except Exception as e:
+            error = e
+            genome_path = None # only set for genomes which actually arrived
+            counter += 1
+    if counter == 10:
+        _log.error("Caught exception %s while moving/downloading genomes" % repr(error))
+        _log.error("Genome %s (path %s) could not be downloaded after 10 tries, check your connection settings" % (genome_id, path))
+    return path, genome_path
+
 """
 Given the created maps and the old config files, creates the required files and new config
+Genomes are downloaded by a pool of threads, since downloading is bound by the network latency
 """
-def write_config(otu_genome_map, genomes_map, out_path, config):
+def write_config(otu_genome_map, genomes_map, out_path, config, threads = 1):
     genome_to_id = os.path.join(out_path, "genome_to_id.tsv")
-    config.set('community0','id_to_genome_file', genome_to_id)
     metadata = os.path.join(out_path, "metadata.tsv")
-    with open(metadata,'w') as md:
-        md.write("genome_ID\tOTU\tNCBI_ID\tnovelty_category\n") # write header
-    config.set('community0','metadata',metadata)
     no_samples = int(config.get("Main","number_of_samples"))
     abundances = [os.path.join(out_path,"abundance%s.tsv" % i) for i in xrange(no_samples)]
     _log.info("Downloading %s genomes" % len(otu_genome_map))
@@ -254,49 +749,50 @@ def write_config(otu_genome_map, genomes_map, out_path, config):
     create_path = os.path.join(out_path,"genomes")
     if not os.path.exists(create_path):
         os.makedirs(create_path)
-    for otu in otu_genome_map:
+    tasks = []
+    added_paths = set()
+    for otu in otu_genome_map: # every genome is only fetched once, even if it is used by multiple OTUs
         taxid, genome_id, path, curr_abundances = otu_genome_map[otu]
-        counter = 0
-        while counter < 10:
-            try:
-                if path.startswith('http') or path.startswith('ftp'):
-                    genome_path = download_genome(path, out_path)
-                else:
-                    out_name = path.rstrip().split('/')[-1]
-                    genome_path = os.path.join(create_path, out_name)
-                    shutil.copy2(path, genome_path)
-                break
-            except Exception as e:
-                error = e
-                counter += 1
-        if counter == 10:
-            _log.error("Caught exception %s while moving/downloading genomes" % repr(e))
-            _log.error("Genome %s (from %s, path %s) could not be downloaded after 10 tries, check your connection settings" % (otu, genome_id, path))
-        with open(genome_to_id,'ab') as gid:
-            gid.write("%s\t%s\n" % (otu, genome_path))
-        with open(metadata,'ab') as md:
+        if path not in added_paths:
+            added_paths.add(path)
+            tasks.append((genome_id, path, out_path))
+    create_session(max(threads, 1))
+    pool = ThreadPool(max(threads, 1))
+    try:
+        genome_paths = dict(pool.imap_unordered(fetch_genome, tasks))
+    finally:
+        pool.close()
+        pool.join()
+        close_session()
+    otus = sorted(otu for otu in otu_genome_map if genome_paths[otu_genome_map[otu][2]] is not None) # sorted, so the output files are written in a fixed order
+    if len(otus) < len(otu_genome_map):
+        _log.warning("Dropping %s OTUs whose genomes could not be downloaded" % (len(otu_genome_map) - len(otus)))
+    with open(genome_to_id,'wb') as gid, open(metadata,'wb') as md:
+        md.write("genome_ID\tOTU\tNCBI_ID\tnovelty_category\n") # write header
+        for otu in otus:
+            taxid, genome_id, path, curr_abundances = otu_genome_map[otu]
+            gid.write("%s\t%s\n" % (otu, genome_paths[path]))
             novelty = genomes_map[genome_id][-1]
             md.write("%s\t%s\t%s\t%s\n" % (otu,taxid,genome_id,novelty))
-        i = 0
-        for abundance in abundances:
-            with open(abundance, 'ab') as ab:
-                ab.write("%s\t%s\n" % (otu,curr_abundances[i]))
-            i += 1
-    abundance_files = ""
-    for abundance in abundances[:-1]:
-        abundance_files += abundance
-        abundance_files += ","
-    abundance_files += abundances[-1] # write csv of abundance files
-    config.set("Main", 'distribution_file_paths', abundance_files)
-    config.set("community0", "num_real_genomes", str(len(otu_genome_map)))
-    config.set("community0", "genomes_total", str(len(otu_genome_map)))
+    abundance_matrix = np.array([otu_genome_map[otu][-1] for otu in otus], dtype=np.float64).reshape(len(otus), no_samples) # otus x samples
+    for i, abundance in enumerate(abundances):
+        with open(abundance,'wb') as ab:
+            np.savetxt(ab, np.rec.fromarrays([otus, abundance_matrix[:, i]]), fmt="%s\t%s")
+    config.set("Main", "distribution_file_paths", ",".join(abundances)) # write csv of abundance files
+    config.set("community0", "id_to_genome_file", genome_to_id)
+    config.set("community0", "metadata", metadata)
+    config.set("community0", "num_real_genomes", str(len(otus)))
+    config.set("community0", "genomes_total", str(len(otus)))
 
     cfg_path = os.path.join(out_path, "config.ini")
     with open(cfg_path, 'wb') as cfg:
         config.write(cfg)
     return cfg_path
 
-def fill_up_genomes(otu_genome_map, unmatched_otus, per_rank_map, tax_profile, debug):
+"""
+Maps the unmatched OTUs (in random order) to the available genomes, every genome is used at most once for filling up
+"""
+def fill_up_genomes(otu_genome_map, unmatched_otus, per_rank_map, tax_profile, debug, name2tax, id2rank):
     genomes = {}
     added_genomes = set()
     for rank in per_rank_map:
@@ -307,22 +803,18 @@ def fill_up_genomes(otu_genome_map, unmatched_otus, per_rank_map, tax_profile, d
                     genomes[taxid].append((path, genome_id))
                     added_genomes.add(path)
     otu_indices = np_rand.choice(len(unmatched_otus),len(unmatched_otus),replace=False)
-    i = 0
-    set_all = False
+    otus_to_fill = deque(unmatched_otus[i] for i in otu_indices) #so we choose a random genome
     for tax_id in genomes:
         for path, genome_id in genomes[tax_id]:
-            curr_otu = unmatched_otus[otu_indices[i]] #so we choose a random genome
+            if len(otus_to_fill) == 0:
+                return otu_genome_map
+            curr_otu = otus_to_fill.popleft()
             lineage, abundances = tax_profile[curr_otu]
-            lin = transform_lineage(lineage, RANKS, MAX_RANK)
             otu_genome_map[curr_otu] = (tax_id, genome_id, path, abundances)
             if debug:
-                _log.warning("Filling up OTU %s (mapped tax id: %s) to genome with tax id %s" % (curr_otu, lin[0], tax_id))
-            i += 1
-            if (i >= len(unmatched_otus) or i >= len(added_genomes)):
-                set_all = True
-                break
-        if (set_all):
-            break
+                lin, lin_ranks = transform_lineage(lineage, RANKS, MAX_RANK, name2tax, id2rank)
+                mapped_id = lin[0] if len(lin) > 0 else None # OTU might not have been mapped to any tax id
+                _log.warning("Filling up OTU %s (mapped tax id: %s) to genome with tax id %s" % (curr_otu, mapped_id, tax_id))
     return otu_genome_map
 
 def generate_input(args):
@@ -346,11 +838,12 @@ def generate_input(args):
         _log.warning("Mu and sigma have not been set, using defaults (1,2)") #TODO 
     tax_profile = read_taxonomic_profile(args.profile, config, args.samples)
     genomes_map, total_genomes = read_genomes_list(args.reference_genomes, args.additional_references)
-    per_rank_map = get_genomes_per_rank(genomes_map, RANKS, MAX_RANK)
-    otu_genome_map, unmatched_otus, per_rank_map = map_otus_to_genomes(tax_profile, per_rank_map, RANKS, MAX_RANK, mu, sigma, max_strains, args.debug, args.no_replace, total_genomes)
+    per_rank_map, genome_locations = get_genomes_per_rank(genomes_map, RANKS, MAX_RANK, args.processes)
+    name2tax, id2rank = get_taxonomy_maps(tax_profile)
+    otu_genome_map, unmatched_otus, per_rank_map = map_otus_to_genomes(tax_profile, per_rank_map, RANKS, MAX_RANK, mu, sigma, max_strains, args.debug, args.no_replace, total_genomes, name2tax, id2rank, genome_locations, args.numba)
     if (args.fill_up and len(unmatched_otus) > 0):
-        otu_genome_map = fill_up_genomes(otu_genome_map, unmatched_otus, per_rank_map, tax_profile, args.debug)
-    cfg_path = write_config(otu_genome_map, genomes_map, args.o, config)
+        otu_genome_map = fill_up_genomes(otu_genome_map, unmatched_otus, per_rank_map, tax_profile, args.debug, name2tax, id2rank)
+    cfg_path = write_config(otu_genome_map, genomes_map, args.o, config, args.threads)
     _log.info("Community design finished")
     _log = None
     return cfg_path